@@ -0,0 +1,91 @@
+import asyncio
+import pathlib
+import sys
+
+import pytest
+
+# Make src/ importable regardless of the directory pytest is started from
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent / "src"))
+
+try:
+    import uvloop
+except ImportError:  # uvloop is optional and not available on Windows
+    uvloop = None
+
+
+def create_mock_env():
+    """Create mock environment variables for testing"""
+    return {
+        'GITHUB_TOKEN': 'ghp_test_token_123456789',
+        'GITHUB_REPOSITORY': 'test-owner/test-repo',
+        'GITHUB_REF': 'refs/pull/123/merge',
+        'INPUT_API_KEY': 'sk-test-api-key-123',
+        'INPUT_MODEL_NAME': 'gpt-4',
+        'INPUT_BASE_URL': 'https://api.openai.com/v1',
+        'INPUT_TEMPERATURE': '0.7',
+        'INPUT_MAX_TOKENS': '1000',
+        'INPUT_MAX_CONCURRENCY': '2',
+        'INPUT_CACHE_DIR': '',  # Empty disables the review cache
+        'INPUT_LANGUAGE': 'English'
+    }
+
+
+# Built once at import; fixtures only apply it
+MOCK_ENV = create_mock_env()
+
+
+@pytest.fixture
+def mock_env(monkeypatch):
+    """Set the mock action environment for one test, covering every input main() reads"""
+    for key, value in MOCK_ENV.items():
+        monkeypatch.setenv(key, value)
+    # The PR number comes from GITHUB_REF, never from a stray event file
+    monkeypatch.delenv('GITHUB_EVENT_PATH', raising=False)
+    return MOCK_ENV
+
+
+@pytest.fixture
+def clean_env(monkeypatch):
+    """Remove the action environment variables for one test"""
+    for key in MOCK_ENV:
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.delenv('GITHUB_EVENT_PATH', raising=False)
+
+
+@pytest.fixture(scope="session")
+def cl100k():
+    """cl100k_base tokenizer, loaded once per test session"""
+    import tiktoken
+
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # The BPE file is downloaded on first use, which needs network access
+        pytest.skip(f"cl100k_base encoding unavailable: {e}")
+
+
+class CharTokenizer:
+    """Offline stand-in for a tiktoken encoding with one token per character"""
+
+    def encode_ordinary(self, text):
+        return list(text)
+
+    def encode_ordinary_batch(self, texts, num_threads=1):
+        return [list(text) for text in texts]
+
+    def decode(self, tokens):
+        return ''.join(tokens)
+
+
+@pytest.fixture(scope="session")
+def char_tokenizer():
+    """Tokenizer whose counts are character counts, so budgets are easy to hit exactly"""
+    return CharTokenizer()
+
+
+def pytest_asyncio_loop_factories(config, item):
+    """Run async tests on uvloop when it is installed, and on the stdlib loop otherwise"""
+    # pytest-asyncio rejects an empty result, so the fallback must name a factory too
+    if uvloop is not None:
+        return {"uvloop": uvloop.new_event_loop}
+    return {"asyncio": asyncio.new_event_loop}
@@ -3,9 +3,14 @@
 Debug script to check environment variables and API connectivity
 """
 import os
+import re
 import sys
-import requests
-from openai import OpenAI
+import asyncio
+import httpx
+from openai import AsyncOpenAI
+
+# Same anchored pattern as main.PR_REF_RE; branch names may contain 'pull'
+PR_REF_RE = re.compile(r'^refs/pull/(\d+)/')
 
 def check_env_vars():
     """Check required environment variables"""
@@ -36,60 +41,60 @@ def check_env_vars():
     
     return missing_vars
 
-def test_github_api():
-    """Test GitHub API connectivity"""
-    print("\n=== GitHub API Test ===")
+async def test_github_api(out):
+    """Test GitHub API connectivity, appending the report lines to `out`"""
+    out.append("\n=== GitHub API Test ===")
     
     token = os.getenv('GITHUB_TOKEN')
     repo = os.getenv('GITHUB_REPOSITORY')
     
     if not token or not repo:
-        print("❌ Missing GitHub credentials")
+        out.append("❌ Missing GitHub credentials")
         return False
     
     try:
         headers = {'Authorization': f'token {token}'}
-        response = requests.get(f'https://api.github.com/repos/{repo}', headers=headers)
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f'https://api.github.com/repos/{repo}', headers=headers)
         
         if response.status_code == 200:
-            print("✅ GitHub API connection successful")
+            out.append("✅ GitHub API connection successful")
             return True
         else:
-            print(f"❌ GitHub API error: {response.status_code} - {response.text}")
+            out.append(f"❌ GitHub API error: {response.status_code} - {response.text}")
             return False
     except Exception as e:
-        print(f"❌ GitHub API connection failed: {e}")
+        out.append(f"❌ GitHub API connection failed: {e}")
         return False
 
-def test_llm_api():
-    """Test LLM API connectivity"""
-    print("\n=== LLM API Test ===")
+async def test_llm_api(out):
+    """Test LLM API connectivity, appending the report lines to `out`"""
+    out.append("\n=== LLM API Test ===")
     
     api_key = os.getenv('INPUT_API_KEY')
     base_url = os.getenv('INPUT_BASE_URL', 'https://api.openai.com/v1')
     model_name = os.getenv('INPUT_MODEL_NAME', 'gpt-4')
     
     if not api_key:
-        print("❌ Missing API key")
+        out.append("❌ Missing API key")
         return False
     
     try:
-        client = OpenAI(api_key=api_key, base_url=base_url)
-        
-        # Test with a simple request
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[{"role": "user", "content": "Hello"}],
-            max_tokens=10
-        )
+        async with AsyncOpenAI(api_key=api_key, base_url=base_url) as client:
+            # Test with a simple request
+            response = await client.chat.completions.create(
+                model=model_name,
+                messages=[{"role": "user", "content": "Hello"}],
+                max_tokens=10
+            )
         
-        print("✅ LLM API connection successful")
-        print(f"Model: {model_name}")
-        print(f"Response: {response.choices[0].message.content}")
+        out.append("✅ LLM API connection successful")
+        out.append(f"Model: {model_name}")
+        out.append(f"Response: {response.choices[0].message.content}")
         return True
         
     except Exception as e:
-        print(f"❌ LLM API connection failed: {e}")
+        out.append(f"❌ LLM API connection failed: {e}")
         return False
 
 def extract_pr_number():
@@ -100,8 +105,9 @@ def extract_pr_number():
     print(f"GITHUB_REF: {github_ref}")
     
     try:
-        if 'pull' in github_ref:
-            pr_number = int(github_ref.split('/')[2])
+        match = PR_REF_RE.match(github_ref)
+        if match:
+            pr_number = int(match.group(1))
             print(f"✅ Extracted PR number: {pr_number}")
             return pr_number
         else:
@@ -123,6 +129,18 @@ def extract_pr_number():
         print(f"❌ Error extracting PR number: {e}")
         return None
 
+async def run_api_checks():
+    """Run the GitHub and LLM connectivity checks at the same time
+
+    Each check buffers its lines, and the sections are printed once both are
+    done, so every result stays under its own header however they finish.
+    """
+    github_out, llm_out = [], []
+    results = await asyncio.gather(test_github_api(github_out), test_llm_api(llm_out))
+    for line in github_out + llm_out:
+        print(line)
+    return results
+
 def main():
     print("🔍 AI PR Review Debug Tool")
     print("=" * 50)
@@ -133,9 +151,8 @@ def main():
     # Extract PR number
     pr_number = extract_pr_number()
     
-    # Test APIs
-    github_ok = test_github_api()
-    llm_ok = test_llm_api()
+    # Test APIs concurrently; the two round-trips are independent
+    github_ok, llm_ok = asyncio.run(run_api_checks())
     
     print("\n=== Summary ===")
     if missing_vars:
@@ -1,11 +1,15 @@
 import os
+import io
 import re
 import asyncio
+import hashlib
+import json
 import tiktoken
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 import github3
-from typing import List, Dict
+from typing import List, Dict, Iterator, Optional, Tuple
 import logging
+from functools import lru_cache
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -13,41 +17,42 @@ logging.basicConfig(level=logging.DEBUG)
 MAX_CHUNK_TOKENS = 6000
 MAX_SUMMARY_TOKENS = 3000
 MIN_FILE_TOKENS = 200
+# Room left in a chunk for the file header and line-number annotations
+PATCH_HEADROOM_TOKENS = 512
 
+HUNK_HEADER_RE = re.compile(r'^@@', re.MULTILINE)
+# refs/pull/{pr_number}/merge or refs/pull/{pr_number}/head
+PR_REF_RE = re.compile(r'^refs/pull/(\d+)/')
 
-def get_pr_diff(github_token: str, repo_name: str, pr_number: int) -> List[Dict]:
-    """Retrieve PR diff with validation"""
-    try:
-        logging.debug(f"Attempting to login with token: {'*' * 10 if github_token else 'None'}")
-        logging.debug(f"Repository: {repo_name}, PR: {pr_number}")
-
-        if not github_token:
-            raise ValueError("GitHub token is required")
-        if not repo_name:
-            raise ValueError("Repository name is required")
-        if not pr_number:
-            raise ValueError("PR number is required")
-
-        gh = github3.login(token=github_token)
-        if not gh:
-            raise ValueError("Failed to authenticate with GitHub")
-
-        owner, repo_name = repo_name.split('/')
-        repo = gh.repository(owner, repo_name)
-        if not repo:
-            raise ValueError(f"Repository {owner}/{repo_name} not found")
-
-        pr = repo.pull_request(pr_number)
-        if not pr:
-            raise ValueError(f"Pull request #{pr_number} not found")
-        
-        # Get actual diff text from GitHub API
-        diff_response = repo._get(f"https://api.github.com/repos/{owner}/{repo_name}/pulls/{pr_number}/files")
-        files = []
+# Files with these extensions have no reviewable text diff
+BINARY_SUFFIXES = ('.bin', '.png', '.jpg', '.jar', '.zip', '.exe', '.dll')
+
+
+def parse_pr_ref(github_ref: str) -> Optional[int]:
+    """Extract the PR number from a pull request ref, or None for other refs"""
+    match = PR_REF_RE.match(github_ref)
+    return int(match.group(1)) if match else None
+
+def read_event_pr_number(event_path: str) -> Optional[int]:
+    """Read the PR number from the workflow's event payload file"""
+    with open(event_path, 'r') as f:
+        event_data = json.load(f)
+    return event_data.get('pull_request', {}).get('number')
+
+def iter_pr_file_pages(repo, pr_number: int) -> Iterator[List[Dict]]:
+    """Yield the PR's changed files one API page at a time, following the Link header"""
+    url = f"{repo._api}/pulls/{pr_number}/files"
+    params = {'per_page': 100}
+    
+    while url:
+        response = repo._get(url, params=params)
+        response.raise_for_status()
         
-        for file in diff_response.json():
-            if not file['filename'].endswith(('png', 'jpg', 'jar')) and file['patch']:
-                files.append({
+        page = []
+        for file in response.json():
+            # Binary and very large files come back without a 'patch' key
+            if not is_binary_file(file['filename']) and file.get('patch'):
+                page.append({
                     'filename': file['filename'],
                     'patch': file['patch'],
                     'status': file['status'],
@@ -55,93 +60,361 @@ def get_pr_diff(github_token: str, repo_name: str, pr_number: int) -> List[Dict]
                     'additions': file['additions'],
                     'deletions': file['deletions']
                 })
+        yield page
         
-        return files
-        
-    except Exception as e:
-        logging.error(f"Diff retrieval failed: {str(e)}")
-        return []
+        # The next link already carries the query string
+        url = response.links.get('next', {}).get('url')
+        params = None
+
+def get_pull_request(github_token: str, repo_name: str, pr_number: int):
+    """Log in and look up the repository and pull request, raising ValueError on failure"""
+    logging.debug(f"Attempting to login with token: {'*' * 10 if github_token else 'None'}")
+    logging.debug(f"Repository: {repo_name}, PR: {pr_number}")
+
+    if not github_token:
+        raise ValueError("GitHub token is required")
+    if not repo_name:
+        raise ValueError("Repository name is required")
+    if not pr_number:
+        raise ValueError("PR number is required")
+
+    gh = github3.login(token=github_token)
+    if not gh:
+        raise ValueError("Failed to authenticate with GitHub")
+
+    owner, repo_name = repo_name.split('/')
+    repo = gh.repository(owner, repo_name)
+    if not repo:
+        raise ValueError(f"Repository {owner}/{repo_name} not found")
+
+    pr = repo.pull_request(pr_number)
+    if not pr:
+        raise ValueError(f"Pull request #{pr_number} not found")
+
+    return repo, pr
+
+def create_client(openai_params: Dict) -> AsyncOpenAI:
+    """Build the async LLM client shared by every request in a run"""
+    # HTTP/2 multiplexes concurrent chunk requests over one TLS connection;
+    # the default client keeps the SDK's timeouts and pool limits
+    return AsyncOpenAI(**openai_params, http_client=DefaultAsyncHttpxClient(http2=True))
+
+@lru_cache(maxsize=4)
+def _get_tokenizer(name: str = "cl100k_base"):
+    """Load a tiktoken encoding once; building the BPE tables is slow"""
+    return tiktoken.get_encoding(name)
 
 def is_binary_file(filename: str) -> bool:
-    return bool(re.search(r'\.(bin|png|jpg|jar|zip|exe|dll)$', filename))
+    return filename.lower().endswith(BINARY_SUFFIXES)
 
-def chunk_files(files: List[Dict], tokenizer) -> List[List[Dict]]:
-    """Group related files into context chunks"""
-    if not files:  # Handle empty input
-        return []
-        
-    chunks = []
-    current_chunk = []
-    current_tokens = 0
+def count_file_tokens(files: List[Dict], tokenizer) -> None:
+    """Store each file's token count under 'tokens', encoding only files not yet counted"""
+    pending = [file for file in files if 'tokens' not in file]
+    if not pending:
+        return
     
-    try:
-        # Sort files by directory to group related files
-        sorted_files = sorted(
-            [f for f in files if f and f.get('filename')],  # Filter out None entries
-            key=lambda x: os.path.dirname(x['filename'])
-        )
+    # Count all patches in one batch; patches are not prompts, so
+    # special-token handling is skipped via encode_ordinary
+    contents = [f"{file['filename']}\n{file['patch']}" for file in pending]
+    token_lists = tokenizer.encode_ordinary_batch(contents, num_threads=os.cpu_count() or 1)
+    for file, tokens in zip(pending, token_lists):
+        file['tokens'] = len(tokens)
+
+def truncate_large_patches(files: List[Dict], tokenizer) -> None:
+    """Cut counted hunks that are over the chunk budget on their own
+
+    Patches whose hunks each fit are left whole for split_large_chunk to spread
+    over several requests. Only a hunk that could never fit in one request,
+    such as the single hunk of an unsplittable patch, is cut at a token boundary;
+    otherwise it would fail at the LLM with a context-length error.
+    """
+    budget = MAX_CHUNK_TOKENS - PATCH_HEADROOM_TOKENS
+    marker = "[... hunk truncated to fit the review budget]\n"
+    for file in files:
+        if file['tokens'] <= budget or file.get('truncated') or file.get('duplicate_of'):
+            continue
         
-        for file in sorted_files:
-            content = f"{file['filename']}\n{file['patch']}"
-            file_tokens = len(tokenizer.encode(content))
-            
-            if file_tokens > MIN_FILE_TOKENS:
-                if current_tokens + file_tokens > MAX_CHUNK_TOKENS:
-                    chunks.append(current_chunk)
-                    current_chunk = []
-                    current_tokens = 0
-                
-                current_chunk.append(file)
-                current_tokens += file_tokens
+        hunks = split_hunks(file['patch'])
+        hunk_tokens = tokenizer.encode_ordinary_batch(hunks, num_threads=os.cpu_count() or 1)
+        reserved = len(tokenizer.encode_ordinary(f"{file['filename']}\n{marker}"))
+        if all(reserved + len(tokens) <= budget for tokens in hunk_tokens):
+            continue
         
-        if current_chunk:
-            chunks.append(current_chunk)
-            
-    except Exception as e:
-        print(f"Error chunking files: {e}")
+        kept = []
+        for hunk, tokens in zip(hunks, hunk_tokens):
+            if reserved + len(tokens) > budget:
+                hunk = tokenizer.decode(tokens[:budget - reserved])
+                if not hunk.endswith('\n'):
+                    hunk += '\n'
+                hunk += marker
+            kept.append(hunk)
+        
+        file['patch'] = ''.join(kept)
+        file['tokens'] = len(tokenizer.encode_ordinary(f"{file['filename']}\n{file['patch']}"))
+        file['truncated'] = True
+        logging.warning(f"Truncated oversized hunks in {file['filename']} to {file['tokens']} tokens")
+
+def mark_duplicate_patches(files: List[Dict], seen: Dict[bytes, str]) -> List[Dict]:
+    """Flag reviewable files whose patch matches an earlier file's, returning the duplicates
+
+    `seen` maps patch digests to the first filename and is carried across calls,
+    so duplicates are found across API pages too.
+    """
+    duplicates = []
+    for file in files:
+        if file['tokens'] <= MIN_FILE_TOKENS:
+            continue
+        key = hashlib.blake2b(file['patch'].encode(), digest_size=16).digest()
+        first = seen.setdefault(key, file['filename'])
+        if first != file['filename']:
+            file['duplicate_of'] = first
+            duplicates.append(file)
+    return duplicates
+
+def format_duplicates(duplicates: List[Dict]) -> str:
+    """List files that were skipped because their changes match an already reviewed file"""
+    lines = [f"- `{file['filename']}`: identical to `{file['duplicate_of']}`" for file in duplicates]
+    return "\n\n### Identical Changes\nFindings for the matched file also apply to these files:\n" + '\n'.join(lines)
+
+class ChunkBuilder:
+    """Pack token-counted files into chunks of at most MAX_CHUNK_TOKENS"""
+
+    def __init__(self):
+        self.current_chunk = []
+        self.current_tokens = 0
+
+    def add(self, file: Dict) -> Optional[List[Dict]]:
+        """Add a file, returning the previous chunk if this file did not fit in it"""
+        file_tokens = file['tokens']
+        if file_tokens <= MIN_FILE_TOKENS or file.get('duplicate_of'):
+            return None
+
+        full_chunk = None
+        if self.current_chunk and self.current_tokens + file_tokens > MAX_CHUNK_TOKENS:
+            full_chunk = self.flush()
+
+        self.current_chunk.append(file)
+        self.current_tokens += file_tokens
+        return full_chunk
+
+    def flush(self) -> Optional[List[Dict]]:
+        """Return the pending chunk, if any, and start a new one"""
+        chunk = self.current_chunk or None
+        self.current_chunk = []
+        self.current_tokens = 0
+        return chunk
+
+def split_hunks(patch: str) -> List[str]:
+    """Split a unified diff patch at its @@ hunk headers, keeping every line"""
+    starts = [match.start() for match in HUNK_HEADER_RE.finditer(patch)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    return [patch[start:end] for start, end in zip(starts, starts[1:] + [len(patch)])]
+
+def split_large_chunk(chunk: Optional[List[Dict]], tokenizer) -> List[List[Dict]]:
+    """Split a chunk holding a single large file into runs of consecutive hunks
+
+    The pieces are then reviewed in parallel instead of the largest file
+    setting the pace for the whole run. Each piece holds up to
+    MAX_CHUNK_TOKENS // 2 tokens of hunks, so a file with many small hunks
+    does not turn into one request (and one review to synthesize) per hunk.
+    Each piece records the line offset of its first hunk so annotated line
+    numbers match the full patch.
+    """
+    if not chunk:
         return []
+    if len(chunk) > 1 or chunk[0]['tokens'] <= MAX_CHUNK_TOKENS // 2:
+        return [chunk]
+    
+    file = chunk[0]
+    hunks = split_hunks(file['patch'])
+    if len(hunks) < 2:
+        return [chunk]
     
-    return chunks
+    target = MAX_CHUNK_TOKENS // 2
+    hunk_tokens = tokenizer.encode_ordinary_batch(hunks, num_threads=os.cpu_count() or 1)
+    pieces = []
+    group, group_tokens = [], 0
+    line_offset = group_offset = file.get('line_offset', 0)
+    for hunk, tokens in zip(hunks, hunk_tokens):
+        if group and group_tokens + len(tokens) > target:
+            pieces.append([{**file, 'patch': ''.join(group), 'tokens': group_tokens, 'line_offset': group_offset}])
+            group, group_tokens, group_offset = [], 0, line_offset
+        group.append(hunk)
+        group_tokens += len(tokens)
+        line_offset += hunk.count('\n')
+    pieces.append([{**file, 'patch': ''.join(group), 'tokens': group_tokens, 'line_offset': group_offset}])
+    return pieces
+
+def sort_by_directory(files: List[Dict]) -> List[Dict]:
+    """Sort files by directory to group related files"""
+    return sorted(
+        [f for f in files if f and f.get('filename')],  # Filter out None entries
+        key=lambda x: os.path.dirname(x['filename'])
+    )
+
+async def produce_files(pages: Iterator[List[Dict]], files_q: asyncio.Queue) -> int:
+    """Fetch file pages off the event loop and queue them; None marks the end
+
+    A failed page fetch is re-raised after the end marker, so the run aborts
+    instead of posting a review that silently misses the remaining files.
+    """
+    total = 0
+    try:
+        while True:
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            total += len(page)
+            await files_q.put(page)
+    except Exception as e:
+        logging.error(f"Diff retrieval failed: {str(e)}")
+        raise
+    finally:
+        await files_q.put(None)
+    return total
+
+async def queue_chunk(chunk: List[Dict], chunks_q: asyncio.Queue, tokenizer, index: int) -> int:
+    """Queue a chunk, split into hunk runs if it is a single large file, and return the piece count
+
+    Pieces are queued as (index, chunk) pairs numbered from `index`, so reviews
+    finishing out of order can be put back in chunk order.
+    """
+    pieces = await asyncio.to_thread(split_large_chunk, chunk, tokenizer)
+    for offset, piece in enumerate(pieces):
+        await chunks_q.put((index + offset, piece))
+    return len(pieces)
+
+async def produce_chunks(files_q: asyncio.Queue, chunks_q: asyncio.Queue, tokenizer, num_workers: int,
+                         duplicates: List[Dict]) -> int:
+    """Chunk file pages as they arrive and queue them numbered in order; one None per worker marks the end"""
+    total = 0
+    builder = ChunkBuilder()
+    seen = {}
+    try:
+        while (page := await files_q.get()) is not None:
+            # GitHub lists files in path order, so sorting within a page keeps directories together
+            page = sort_by_directory(page)
+            # tiktoken releases the GIL while encoding, so counting in a worker thread
+            # overlaps with page fetches and in-flight reviews on the event loop
+            await asyncio.to_thread(count_file_tokens, page, tokenizer)
+            # Hash the original patches; truncation would make distinct files look identical
+            duplicates.extend(mark_duplicate_patches(page, seen))
+            await asyncio.to_thread(truncate_large_patches, page, tokenizer)
+            for file in page:
+                if full_chunk := builder.add(file):
+                    total += await queue_chunk(full_chunk, chunks_q, tokenizer, total)
+
+        if last_chunk := builder.flush():
+            total += await queue_chunk(last_chunk, chunks_q, tokenizer, total)
+    finally:
+        for _ in range(num_workers):
+            await chunks_q.put(None)
+    return total
+
+async def review_chunks(chunks_q: asyncio.Queue, config: Dict, client: AsyncOpenAI,
+                        reviews: List[Tuple[int, str]]) -> None:
+    """Review queued chunks until the end marker, collecting (index, review) pairs"""
+    while (item := await chunks_q.get()) is not None:
+        index, chunk = item
+        reviews.append((index, await process_chunk(chunk, config, client)))
+
+def log_prompt_cache_usage(usage) -> None:
+    """Log how many prompt tokens were served from the provider's prompt cache"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', None) or 0
+    logging.debug(f"Prompt tokens: {usage.prompt_tokens}, cached: {cached}")
+
+def review_cache_key(full_diff: str, config: Dict) -> str:
+    """Key a chunk review by everything that determines the model's answer"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (config['model_name'], config['chunk_prompt'], full_diff):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def read_cached_review(cache_dir: str, key: str) -> Optional[str]:
+    """Return a review stored by an earlier run, or None on a miss"""
+    try:
+        with open(os.path.join(cache_dir, f"{key}.md"), 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logging.warning(f"Failed to read review cache: {e}")
+        return None
 
-async def process_chunk(chunk: List[Dict], config: Dict) -> str:
+def write_cached_review(cache_dir: str, key: str, review: str) -> None:
+    """Store a review for later runs; a failed write only costs a future cache miss"""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, f"{key}.md"), 'w', encoding='utf-8') as f:
+            f.write(review)
+    except OSError as e:
+        logging.warning(f"Failed to write review cache: {e}")
+
+def annotate_patch(file: Dict) -> str:
+    """Render a file header and its patch lines numbered for the model to cite"""
+    buf = io.StringIO()
+    buf.write(f"File: {file['filename']} ({file['status']})")
+    for i, line in enumerate(file['patch'].split('\n'), file.get('line_offset', 0) + 1):
+        if line:
+            buf.write(f"\n{i}: {line}")
+    return buf.getvalue()
+
+async def process_chunk(chunk: List[Dict], config: Dict, client: AsyncOpenAI) -> str:
     """Analyze with strict context binding"""
-    client = OpenAI(**config['openai_params'])
-    
     # Build diff with line numbers
-    diff_text = []
-    for file in chunk:
-        lines = file['patch'].split('\n')
-        annotated = [f"File: {file['filename']} ({file['status']})"]
-        annotated += [f"{i+1}: {line}" for i, line in enumerate(lines) if line]
-        diff_text.append('\n'.join(annotated))
-    
-    full_diff = '\n\n'.join(diff_text)
+    full_diff = '\n\n'.join(annotate_patch(file) for file in chunk)
     
     # Validate diff content
     if not full_diff.strip():
         logging.warning("Empty diff chunk skipped")
         return ""
     
+    cache_dir = config.get('cache_dir')
+    if cache_dir:
+        cache_key = review_cache_key(full_diff, config)
+        cached_review = read_cached_review(cache_dir, cache_key)
+        if cached_review is not None:
+            logging.debug(f"Using cached review {cache_key}")
+            return cached_review
+    
     logging.debug(f"Processing chunk with {len(full_diff)} characters")
     
-    response = client.chat.completions.create(
+    stream = await client.chat.completions.create(
         model=config['model_name'],
         messages=[
             {"role": "system", "content": config['chunk_prompt']},
-            {"role": "user", "content": f"CODE DIFF:\n{full_diff}\n\nANALYSIS REQUEST:\n{config['chunk_prompt']}"}
+            # Keep the static instructions as the only prefix and the diff last, so
+            # provider-side prompt caching can reuse the prefix across chunks
+            {"role": "user", "content": f"CODE DIFF:\n{full_diff}"}
         ],
         temperature=0.3,  # More focused
-        max_tokens=1500
+        max_tokens=1500,
+        stream=True,
+        stream_options={"include_usage": True}
     )
     
-    return response.choices[0].message.content
+    # Accumulate deltas as they arrive instead of waiting for the full body
+    parts = []
+    async for event in stream:
+        if event.choices and event.choices[0].delta.content:
+            parts.append(event.choices[0].delta.content)
+        if event.usage:
+            log_prompt_cache_usage(event.usage)
+    
+    review = ''.join(parts)
+    if cache_dir and review.strip():
+        write_cached_review(cache_dir, cache_key, review)
+    
+    return review
 
-async def synthesize_reviews(reviews: List[str], config: Dict) -> str:
+async def synthesize_reviews(reviews: List[str], config: Dict, client: AsyncOpenAI) -> str:
     """Create final summary from chunk reviews"""
-    client = OpenAI(**config['openai_params'])
     combined = "\n\n---\n\n".join(reviews)
     
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model=config['model_name'],
         messages=[
             {"role": "system", "content": config['summary_prompt']},
@@ -178,6 +451,8 @@ async def main():
         'model_name': os.getenv('INPUT_MODEL_NAME', 'gpt-4'),
         'temperature': float(os.getenv('INPUT_TEMPERATURE', 0.7)),
         'max_tokens': int(os.getenv('INPUT_MAX_TOKENS', 1000)),
+        'max_concurrency': max(1, int(os.getenv('INPUT_MAX_CONCURRENCY', 8))),
+        'cache_dir': os.getenv('INPUT_CACHE_DIR', ''),
         'chunk_prompt': """Analyze THESE SPECIFIC CODE CHANGES from a pull request:
 - Focus ONLY on the provided diff
 - Ignore examples from other contexts
@@ -207,7 +482,7 @@ Format as:
 - [Priority] [Type] Line X: Description (Code Snippet)"""
     }
     
-    tokenizer = tiktoken.get_encoding("cl100k_base")
+    tokenizer = _get_tokenizer()
 
     # Get PR data (variables already validated above)
 
@@ -216,16 +491,12 @@ Format as:
     logging.debug(f"GITHUB_REF: {github_ref}")
 
     try:
-        if 'pull' in github_ref:
-            pr_number = int(github_ref.split('/')[2])
-        else:
+        pr_number = parse_pr_ref(github_ref)
+        if pr_number is None:
             # Fallback: try to get from GITHUB_EVENT_PATH
-            import json
             event_path = os.getenv('GITHUB_EVENT_PATH')
             if event_path:
-                with open(event_path, 'r') as f:
-                    event_data = json.load(f)
-                    pr_number = event_data.get('pull_request', {}).get('number')
+                pr_number = read_event_pr_number(event_path)
             else:
                 raise ValueError("Cannot determine PR number")
     except (ValueError, IndexError, KeyError) as e:
@@ -233,42 +504,70 @@ Format as:
         logging.error(f"GITHUB_REF: {github_ref}")
         return
     
-    files = get_pr_diff(github_token, repo_name, pr_number)
-
-    if not files:
-        logging.warning("No files found in PR diff")
-        # Post a simple message instead of failing
-        gh = github3.login(token=github_token)
-        owner, repo = repo_name.split('/')
-        pr = gh.repository(owner, repo).pull_request(pr_number)
-        pr.create_comment("🤖 AI Review: No code changes detected in this PR.")
+    try:
+        repo, pr = get_pull_request(github_token, repo_name, pr_number)
+    except Exception as e:
+        logging.error(f"Diff retrieval failed: {str(e)}")
         return
 
-    chunks = chunk_files(files, tokenizer)
+    # One client for the whole run so every request reuses its connection pool
+    client = create_client(config['openai_params'])
+    try:
+        # Pipeline the stages so early chunks are being reviewed while later
+        # file pages are still being fetched and tokenized. The worker count
+        # caps in-flight requests to stay under provider rate limits.
+        files_q = asyncio.Queue()
+        chunks_q = asyncio.Queue()
+        chunk_reviews = []
+        duplicates = []
+        num_workers = config['max_concurrency']
 
-    if not chunks:
-        logging.warning("No valid chunks created from files")
-        return
+        tasks = [
+            asyncio.create_task(produce_files(iter_pr_file_pages(repo, pr_number), files_q)),
+            asyncio.create_task(produce_chunks(files_q, chunks_q, tokenizer, num_workers, duplicates)),
+            *[asyncio.create_task(review_chunks(chunks_q, config, client, chunk_reviews))
+              for _ in range(num_workers)]
+        ]
+        try:
+            file_count, chunk_count, *_ = await asyncio.gather(*tasks)
+        finally:
+            # gather leaves the other stages running when one fails; stop them
+            # before the client closes so no review is left mid-request
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-    # Process chunks in parallel
-    chunk_reviews = await asyncio.gather(*[
-        process_chunk(chunk, config) for chunk in chunks
-    ])
+        if not file_count:
+            logging.warning("No files found in PR diff")
+            # Post a simple message instead of failing
+            pr.create_comment("🤖 AI Review: No code changes detected in this PR.")
+            return
 
-    # Filter out empty reviews
-    valid_reviews = [review for review in chunk_reviews if review and review.strip()]
+        if not chunk_count:
+            logging.warning("No valid chunks created from files")
+            return
 
-    if not valid_reviews:
-        logging.warning("No valid reviews generated")
-        return
+        # Workers finish in any order; restore chunk order so the synthesis input
+        # is stable across runs and a split file's pieces stay in sequence.
+        # Empty reviews are filtered out.
+        chunk_reviews.sort(key=lambda item: item[0])
+        valid_reviews = [review for _, review in chunk_reviews if review and review.strip()]
+
+        if not valid_reviews:
+            logging.warning("No valid reviews generated")
+            return
 
-    # Generate final summary
-    final_report = await synthesize_reviews(valid_reviews, config)
+        # Generate final summary; a single review has nothing to merge
+        if len(valid_reviews) == 1:
+            final_report = valid_reviews[0]
+        else:
+            final_report = await synthesize_reviews(valid_reviews, config, client)
+        if duplicates:
+            final_report += format_duplicates(duplicates)
+    finally:
+        await client.close()
     
-    # Post to GitHub
-    gh = github3.login(token=github_token)
-    owner, repo = repo_name.split('/')
-    pr = gh.repository(owner, repo).pull_request(pr_number)
+    # Post to GitHub, reusing the session that fetched the diff
     pr.create_comment(final_report)
 
 if __name__ == "__main__":
@@ -1,219 +1,529 @@
-#!/usr/bin/env python3
 """
-Test script to validate the fixes made to the AI PR review tool
+Tests validating the fixes made to the AI PR review tool
+
+Run with: pytest -n auto test_fixes.py
 """
 import os
-import sys
+import re
 import asyncio
-from unittest.mock import patch, MagicMock
-import tempfile
-import json
-
-# Add src to path
-sys.path.insert(0, 'src')
-
-def create_mock_env():
-    """Create mock environment variables for testing"""
-    return {
-        'GITHUB_TOKEN': 'ghp_test_token_123456789',
-        'GITHUB_REPOSITORY': 'test-owner/test-repo',
-        'GITHUB_REF': 'refs/pull/123/merge',
-        'INPUT_API_KEY': 'sk-test-api-key-123',
-        'INPUT_MODEL_NAME': 'gpt-4',
-        'INPUT_BASE_URL': 'https://api.openai.com/v1',
-        'INPUT_TEMPERATURE': '0.7',
-        'INPUT_MAX_TOKENS': '1000',
-        'INPUT_LANGUAGE': 'English'
-    }
+import importlib.util
+from collections.abc import Mapping
+import httpx
+import openai
+import orjson
+import pytest
 
-def test_pr_number_extraction():
-    """Test PR number extraction logic"""
-    print("Testing PR number extraction...")
-    
-    test_cases = [
-        ('refs/pull/123/merge', 123),
-        ('refs/pull/456/head', 456),
-        ('refs/heads/main', None),  # Should fail gracefully
-    ]
-    
-    for github_ref, expected in test_cases:
-        try:
-            if 'pull' in github_ref:
-                pr_number = int(github_ref.split('/')[2])
-                assert pr_number == expected, f"Expected {expected}, got {pr_number}"
-                print(f"✅ {github_ref} -> {pr_number}")
-            else:
-                print(f"✅ {github_ref} -> No PR number (expected)")
-        except Exception as e:
-            if expected is None:
-                print(f"✅ {github_ref} -> Failed as expected")
-            else:
-                print(f"❌ {github_ref} -> Unexpected error: {e}")
-
-def test_environment_validation():
-    """Test environment variable validation"""
-    print("\nTesting environment validation...")
-    
-    # Test with missing variables
-    with patch.dict(os.environ, {}, clear=True):
-        try:
-            from main import main
-            # This should fail gracefully
-            print("✅ Handles missing environment variables")
-        except Exception as e:
-            print(f"❌ Unexpected error with missing env vars: {e}")
-    
-    # Test with valid variables
-    mock_env = create_mock_env()
-    with patch.dict(os.environ, mock_env, clear=True):
-        try:
-            # Import should work
-            from main import main
-            print("✅ Accepts valid environment variables")
-        except Exception as e:
-            print(f"❌ Error with valid env vars: {e}")
-
-def test_github_api_error_handling():
-    """Test GitHub API error handling"""
-    print("\nTesting GitHub API error handling...")
-    
-    try:
-        from main import get_pr_diff
-        
-        # Test with invalid inputs
-        result = get_pr_diff(None, "test/repo", 123)
-        assert result == [], "Should return empty list for None token"
-        print("✅ Handles None token")
-        
-        result = get_pr_diff("token", None, 123)
-        assert result == [], "Should return empty list for None repo"
-        print("✅ Handles None repository")
-        
-        result = get_pr_diff("token", "test/repo", None)
-        assert result == [], "Should return empty list for None PR number"
-        print("✅ Handles None PR number")
-        
-    except Exception as e:
-        print(f"❌ Error in GitHub API error handling: {e}")
-
-def test_chunk_files_empty_input():
-    """Test chunk_files with empty input"""
-    print("\nTesting chunk_files with empty input...")
-    
-    try:
-        from main import chunk_files
-        import tiktoken
-        
-        tokenizer = tiktoken.get_encoding("cl100k_base")
-        
-        # Test empty list
-        result = chunk_files([], tokenizer)
-        assert result == [], "Should return empty list for empty input"
-        print("✅ Handles empty file list")
-        
-        # Test None input
-        result = chunk_files(None, tokenizer)
-        assert result == [], "Should return empty list for None input"
-        print("✅ Handles None input")
-        
-    except Exception as e:
-        print(f"❌ Error in chunk_files testing: {e}")
-
-def create_test_event_file():
-    """Create a test GitHub event file"""
-    event_data = {
-        "pull_request": {
-            "number": 789,
-            "title": "Test PR",
-            "body": "Test PR body"
-        }
+from openai import AsyncOpenAI
+
+import main as main_module
+from main import (
+    parse_pr_ref, read_event_pr_number, get_pull_request, iter_pr_file_pages,
+    count_file_tokens, sort_by_directory, truncate_large_patches, mark_duplicate_patches, format_duplicates,
+    ChunkBuilder, split_hunks, split_large_chunk, produce_files, produce_chunks,
+    review_cache_key, read_cached_review, write_cached_review,
+    process_chunk, synthesize_reviews,
+    MAX_CHUNK_TOKENS, MIN_FILE_TOKENS, PATCH_HEADROOM_TOKENS
+)
+
+# Serialized once; tests only write the bytes
+_EVENT_JSON = orjson.dumps({
+    "pull_request": {
+        "number": 789,
+        "title": "Test PR",
+        "body": "Test PR body"
     }
-    
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as f:
-        json.dump(event_data, f)
-        return f.name
+})
 
-def test_pr_number_from_event():
-    """Test PR number extraction from event file"""
-    print("\nTesting PR number extraction from event file...")
-    
-    event_file = create_test_event_file()
-    
+def test_loop_factory_without_uvloop(monkeypatch):
+    """Test that the suite still gets a usable event loop where uvloop is not installed"""
+    import conftest
+    monkeypatch.setattr(conftest, "uvloop", None)
+    factories = conftest.pytest_asyncio_loop_factories(None, None)
+    assert list(factories) == ["asyncio"]
+
+    loop = factories["asyncio"]()
     try:
-        mock_env = {
-            'GITHUB_REF': 'refs/heads/feature-branch',  # No PR in ref
-            'GITHUB_EVENT_PATH': event_file
-        }
-        
-        with patch.dict(os.environ, mock_env, clear=True):
-            # Test the extraction logic
-            github_ref = os.getenv('GITHUB_REF', '')
-            if 'pull' not in github_ref:
-                event_path = os.getenv('GITHUB_EVENT_PATH')
-                if event_path and os.path.exists(event_path):
-                    with open(event_path, 'r') as f:
-                        event_data = json.load(f)
-                        pr_number = event_data.get('pull_request', {}).get('number')
-                        assert pr_number == 789, f"Expected 789, got {pr_number}"
-                        print("✅ Extracted PR number from event file")
-    
-    except Exception as e:
-        print(f"❌ Error testing event file extraction: {e}")
-    
+        assert loop.run_until_complete(asyncio.sleep(0, result=42)) == 42
     finally:
-        # Clean up
-        try:
-            os.unlink(event_file)
-        except:
-            pass
-
-async def test_async_functions():
-    """Test async function error handling"""
-    print("\nTesting async functions...")
-    
-    try:
-        from main import synthesize_reviews
-        
-        # Test with empty reviews
-        config = {
-            'openai_params': {'api_key': 'test', 'base_url': 'https://api.openai.com/v1'},
-            'model_name': 'gpt-4',
-            'summary_prompt': 'Test prompt'
-        }
-        
-        # This will fail due to invalid API key, but should handle gracefully
-        try:
-            result = await synthesize_reviews([], config)
-            print("✅ Handles empty reviews list")
-        except Exception as e:
-            # Expected to fail with API error, not with empty list error
-            if "empty" not in str(e).lower():
-                print("✅ Fails gracefully with API error (expected)")
-            else:
-                print(f"❌ Unexpected empty list error: {e}")
-    
-    except Exception as e:
-        print(f"❌ Error in async function testing: {e}")
-
-def main():
-    """Run all tests"""
-    print("🧪 Testing AI PR Review Fixes")
-    print("=" * 50)
-    
-    test_pr_number_extraction()
-    test_environment_validation()
-    test_github_api_error_handling()
-    test_chunk_files_empty_input()
-    test_pr_number_from_event()
-    
-    # Run async tests
-    try:
-        asyncio.run(test_async_functions())
-    except Exception as e:
-        print(f"❌ Error running async tests: {e}")
-    
-    print("\n" + "=" * 50)
-    print("✅ Test suite completed!")
-
-if __name__ == "__main__":
-    main()
+        loop.close()
+
+@pytest.mark.parametrize("github_ref,expected", [
+    ('refs/pull/123/merge', 123),
+    ('refs/pull/456/head', 456),
+    ('refs/heads/main', None),  # No PR number in a branch ref
+])
+def test_pr_number_extraction(github_ref, expected):
+    """Test PR number extraction from GITHUB_REF"""
+    assert parse_pr_ref(github_ref) == expected
+
+class _UnreadableEnviron(Mapping):
+    """Stand-in for os.environ that fails on any read"""
+    def __getitem__(self, key):
+        raise AssertionError(f"main read {key} from the environment at import time")
+    def __iter__(self):
+        raise AssertionError("main iterated the environment at import time")
+    def __len__(self):
+        raise AssertionError("main inspected the environment at import time")
+
+def test_main_import_does_not_read_environment(monkeypatch):
+    """Test that importing main reads no environment variables"""
+    # Execute a fresh copy so the shared module the other tests use is untouched
+    spec = importlib.util.find_spec("main")
+    module = importlib.util.module_from_spec(spec)
+    # Scoped so pytest can still update os.environ around the test
+    with monkeypatch.context() as m:
+        m.setattr(os, "environ", _UnreadableEnviron())
+        spec.loader.exec_module(module)
+    assert callable(module.main)
+
+@pytest.fixture(autouse=True)
+def _no_github_login(monkeypatch):
+    """Fail loudly instead of opening a real GitHub session"""
+    def login(*args, **kwargs):
+        # pytest.fail raises a BaseException, so no `except Exception` can swallow it
+        pytest.fail("tests must not log in to GitHub")
+    monkeypatch.setattr(main_module.github3, "login", login)
+
+@pytest.mark.parametrize("token,repo,pr_number", [
+    (None, "test/repo", 123),
+    ("token", None, 123),
+    ("token", "test/repo", None),
+], ids=["no-token", "no-repo", "no-pr-number"])
+def test_github_api_error_handling(token, repo, pr_number):
+    """Test that get_pull_request rejects missing inputs before logging in"""
+    with pytest.raises(ValueError):
+        get_pull_request(token, repo, pr_number)
+
+def test_sort_by_directory_skips_empty_entries():
+    """Test that entries without a filename are dropped while sorting"""
+    files = [{'filename': 'src/b.py'}, None, {}, {'filename': 'a.py'}]
+    assert [f['filename'] for f in sort_by_directory(files)] == ['a.py', 'src/b.py']
+    assert sort_by_directory([]) == []
+
+def test_count_file_tokens(cl100k):
+    """Test that token counts cover the filename header and are only computed once"""
+    files = [{'filename': 'a.py', 'patch': '+x = 1\n'}, {'filename': 'b.py', 'patch': '+y\n', 'tokens': 42}]
+    count_file_tokens(files, cl100k)
+    assert files[0]['tokens'] == len(cl100k.encode_ordinary('a.py\n+x = 1\n'))
+    assert files[1]['tokens'] == 42
+
+def _hunk(start, lines, text="+x"):
+    return f"@@ -{start},{lines} +{start},{lines} @@\n" + f"{text}\n" * lines
+
+def _file(filename, patch):
+    return {'filename': filename, 'patch': patch, 'status': 'modified'}
+
+def test_split_hunks_keeps_every_line():
+    """Test that a patch splits at hunk headers and rejoins to the original"""
+    patch = "preamble\n" + _hunk(1, 2) + _hunk(10, 3)
+    hunks = split_hunks(patch)
+    assert hunks == ["preamble\n", _hunk(1, 2), _hunk(10, 3)]
+    assert ''.join(hunks) == patch
+    assert split_hunks("+no header\n") == ["+no header\n"]
+
+def test_truncate_keeps_patches_whose_hunks_fit(char_tokenizer):
+    """Test that a large many-hunk patch is left whole for split_large_chunk"""
+    patch = ''.join(_hunk(i * 100, 500) for i in range(20))
+    files = [_file('big.py', patch)]
+    count_file_tokens(files, char_tokenizer)
+    truncate_large_patches(files, char_tokenizer)
+    assert files[0]['patch'] == patch
+    assert 'truncated' not in files[0]
+
+def test_truncate_cuts_only_the_oversized_hunk(char_tokenizer):
+    """Test that a hunk over budget by itself is cut and its neighbours are kept"""
+    small, huge = _hunk(1, 10), _hunk(100, MAX_CHUNK_TOKENS, "+y")
+    files = [_file('big.py', small + huge + small)]
+    count_file_tokens(files, char_tokenizer)
+    truncate_large_patches(files, char_tokenizer)
+
+    file = files[0]
+    assert file['truncated']
+    assert file['patch'].startswith(small) and file['patch'].endswith(small)
+    assert file['patch'].count("[... hunk truncated to fit the review budget]") == 1
+    cut_hunk = split_hunks(file['patch'])[1]
+    assert len(f"{file['filename']}\n{cut_hunk}") <= MAX_CHUNK_TOKENS - PATCH_HEADROOM_TOKENS
+
+    # A second pass must not stack another truncation marker
+    patch = file['patch']
+    truncate_large_patches(files, char_tokenizer)
+    assert file['patch'] == patch
+
+def test_split_large_chunk_groups_hunks_with_line_offsets(char_tokenizer):
+    """Test that hunks are packed into bounded pieces whose offsets match the full patch"""
+    hunks = [_hunk(i * 100, 200) for i in range(12)]
+    file = _file('big.py', ''.join(hunks))
+    count_file_tokens([file], char_tokenizer)
+    pieces = split_large_chunk([file], char_tokenizer)
+
+    assert 1 < len(pieces) < len(hunks)
+    assert ''.join(piece[0]['patch'] for piece in pieces) == file['patch']
+    for piece in pieces:
+        assert piece[0]['tokens'] <= MAX_CHUNK_TOKENS // 2
+
+    # Each piece starts where the previous ones' lines end
+    offset = 0
+    for (piece,) in pieces:
+        assert piece['line_offset'] == offset
+        offset += piece['patch'].count('\n')
+
+def test_split_large_chunk_leaves_small_chunks_alone(char_tokenizer):
+    """Test that multi-file chunks, small files and single-hunk files are not split"""
+    small = _file('a.py', _hunk(1, 10) + _hunk(50, 10))
+    single = _file('b.py', _hunk(1, MAX_CHUNK_TOKENS))
+    count_file_tokens([small, single], char_tokenizer)
+    assert split_large_chunk([small], char_tokenizer) == [[small]]
+    assert split_large_chunk([single], char_tokenizer) == [[single]]
+    assert split_large_chunk([small, single], char_tokenizer) == [[small, single]]
+    assert split_large_chunk(None, char_tokenizer) == []
+
+def test_chunk_builder_packs_within_budget():
+    """Test that trivial and duplicate files are skipped and full chunks are flushed"""
+    builder = ChunkBuilder()
+    assert builder.add({'filename': 'tiny.py', 'tokens': MIN_FILE_TOKENS}) is None
+    assert builder.add({'filename': 'dup.py', 'tokens': 1000, 'duplicate_of': 'a.py'}) is None
+
+    first = {'filename': 'a.py', 'tokens': MAX_CHUNK_TOKENS - 1000}
+    second = {'filename': 'b.py', 'tokens': 1000}
+    third = {'filename': 'c.py', 'tokens': MIN_FILE_TOKENS + 1}
+    assert builder.add(first) is None
+    assert builder.add(second) is None
+    assert builder.add(third) == [first, second]
+    assert builder.flush() == [third]
+    assert builder.flush() is None
+
+def test_mark_duplicate_patches_across_pages():
+    """Test that duplicates are found across calls sharing one digest map"""
+    patch = "+" + "x" * 1000
+    seen = {}
+    first_page = [
+        {'filename': 'a.py', 'patch': patch, 'tokens': 1000},
+        {'filename': 'tiny1.py', 'patch': '+y', 'tokens': 1},
+    ]
+    second_page = [
+        {'filename': 'b.py', 'patch': patch, 'tokens': 1000},
+        {'filename': 'tiny2.py', 'patch': '+y', 'tokens': 1},
+    ]
+    assert mark_duplicate_patches(first_page, seen) == []
+    assert mark_duplicate_patches(second_page, seen) == [second_page[0]]
+    assert second_page[0]['duplicate_of'] == 'a.py'
+    assert 'duplicate_of' not in second_page[1]
+
+def test_format_duplicates_lists_skipped_files():
+    """Test that each skipped file is listed against the file whose findings cover it"""
+    footer = format_duplicates([{'filename': 'b.py', 'duplicate_of': 'a.py'}])
+    assert "### Identical Changes" in footer
+    assert "Findings for the matched file also apply to these files:" in footer
+    assert footer.endswith("- `b.py`: identical to `a.py`")
+
+async def test_produce_chunks_numbers_chunks_in_order(char_tokenizer):
+    """Test that chunks, including the pieces of a split file, are queued with sequential indexes"""
+    page = [
+        _file('a.py', _hunk(1, 300)),
+        _file('big.py', ''.join(_hunk(i * 100, 400) for i in range(6))),
+        _file('z.py', _hunk(1, 300)),
+    ]
+    files_q, chunks_q = asyncio.Queue(), asyncio.Queue()
+    await files_q.put(page)
+    await files_q.put(None)
+
+    total = await produce_chunks(files_q, chunks_q, char_tokenizer, 2, [])
+    items = [chunks_q.get_nowait() for _ in range(total)]
+    assert [index for index, _ in items] == list(range(total))
+    big_pieces = [chunk[0] for _, chunk in items if chunk[0]['filename'] == 'big.py']
+    assert len(big_pieces) > 1
+    assert [piece['line_offset'] for piece in big_pieces] == sorted(piece['line_offset'] for piece in big_pieces)
+    assert [chunks_q.get_nowait(), chunks_q.get_nowait()] == [None, None]
+
+async def test_duplicates_compare_original_patches(char_tokenizer):
+    """Test that patches which only match once truncated are both reviewed"""
+    prefix = _hunk(1, MAX_CHUNK_TOKENS)
+    page = [_file('a.py', prefix + "+tail a\n"), _file('b.py', prefix + "+tail b\n")]
+    files_q, chunks_q = asyncio.Queue(), asyncio.Queue()
+    await files_q.put(page)
+    await files_q.put(None)
+
+    duplicates = []
+    await produce_chunks(files_q, chunks_q, char_tokenizer, 1, duplicates)
+    assert duplicates == []
+    assert all(file['truncated'] for file in page)
+
+class _FakeResponse:
+    def __init__(self, files, next_url=None):
+        self._files = files
+        self.links = {'next': {'url': next_url}} if next_url else {}
+
+    def raise_for_status(self):
+        if isinstance(self._files, Exception):
+            raise self._files
+
+    def json(self):
+        return self._files
+
+class _FakeRepo:
+    """Serves canned file pages the way github3 would, recording each request"""
+    _api = "https://api.github.com/repos/o/r"
+
+    def __init__(self, pages):
+        self._pages = pages
+        self.calls = []
+
+    def _get(self, url, params=None):
+        self.calls.append((url, params))
+        return self._pages[url]
+
+def _api_file(filename, patch='+x'):
+    return {'filename': filename, 'patch': patch, 'status': 'modified',
+            'changes': 1, 'additions': 1, 'deletions': 0}
+
+def test_iter_pr_file_pages_follows_link_header():
+    """Test that pages are fetched until there is no next link, dropping unreviewable files"""
+    first_url = f"{_FakeRepo._api}/pulls/7/files"
+    next_url = f"{first_url}?per_page=100&page=2"
+    no_patch = _api_file('huge.sql')
+    del no_patch['patch']
+    repo = _FakeRepo({
+        first_url: _FakeResponse([_api_file('a.py'), _api_file('logo.png')], next_url),
+        next_url: _FakeResponse([_api_file('b.py'), no_patch]),
+    })
+
+    pages = list(iter_pr_file_pages(repo, 7))
+    assert [[f['filename'] for f in page] for page in pages] == [['a.py'], ['b.py']]
+    # The next link carries its own query string, so params are only sent once
+    assert repo.calls == [(first_url, {'per_page': 100}), (next_url, None)]
+
+async def test_produce_files_reraises_after_end_marker():
+    """Test that a failed page fetch still ends the queue and then aborts the run"""
+    def pages():
+        yield [_api_file('a.py')]
+        raise RuntimeError("502 Bad Gateway")
+
+    files_q = asyncio.Queue()
+    with pytest.raises(RuntimeError, match="502"):
+        await produce_files(pages(), files_q)
+    assert files_q.get_nowait() == [_api_file('a.py')]
+    assert files_q.get_nowait() is None
+
+def test_review_cache_round_trip(tmp_path):
+    """Test that a stored review is read back only for the same model, prompt and diff"""
+    config = {'model_name': 'gpt-4', 'chunk_prompt': 'Review this'}
+    key = review_cache_key("diff", config)
+    cache_dir = str(tmp_path / "reviews")
+
+    assert read_cached_review(cache_dir, key) is None
+    write_cached_review(cache_dir, key, "- [LOW] [Style] a.py:1 - Example")
+    assert read_cached_review(cache_dir, key) == "- [LOW] [Style] a.py:1 - Example"
+
+    assert review_cache_key("other diff", config) != key
+    assert review_cache_key("diff", {**config, 'model_name': 'gpt-4o'}) != key
+    assert review_cache_key("diff", {**config, 'chunk_prompt': 'Be strict'}) != key
+
+@pytest.fixture
+def event_file(tmp_path):
+    """Write the test GitHub event payload to a temporary file"""
+    path = tmp_path / "event.json"
+    path.write_bytes(_EVENT_JSON)
+    return str(path)
+
+def test_pr_number_from_event(clean_env, monkeypatch, event_file):
+    """Test PR number extraction from event file"""
+    monkeypatch.setenv('GITHUB_REF', 'refs/heads/feature-branch')  # No PR in ref
+    monkeypatch.setenv('GITHUB_EVENT_PATH', event_file)
+
+    assert parse_pr_ref(os.getenv('GITHUB_REF', '')) is None
+    assert read_event_pr_number(os.getenv('GITHUB_EVENT_PATH')) == 789
+
+_SUMMARY_CONFIG = {'model_name': 'gpt-4', 'summary_prompt': 'Test prompt'}
+
+def _mock_client(handler) -> AsyncOpenAI:
+    """Client whose requests are answered by `handler` instead of the network"""
+    return AsyncOpenAI(
+        api_key='test', base_url='https://api.openai.com/v1', max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+
+async def _probe_synthesis(reviews, client, expected):
+    with pytest.raises(expected):
+        await synthesize_reviews(reviews, _SUMMARY_CONFIG, client)
+
+async def test_synthesis_surfaces_api_errors():
+    """Test that a rejected request surfaces as an API error for empty and valid review lists"""
+    def reject(request):
+        return httpx.Response(401, json={"error": {"message": "Incorrect API key", "type": "invalid_request_error",
+                                                   "code": "invalid_api_key"}})
+
+    # The probes are independent, so they share one client and run concurrently
+    async with _mock_client(reject) as client:
+        await asyncio.gather(
+            _probe_synthesis([], client, openai.AuthenticationError),
+            _probe_synthesis(["- [LOW] [Style] a.py:1 - Example"], client, openai.AuthenticationError),
+        )
+
+async def test_synthesis_sends_combined_reviews():
+    """Test that the reviews are sent as one separated message and the reply is returned"""
+    requests = []
+    def reply(request):
+        requests.append(orjson.loads(request.content))
+        return httpx.Response(200, json={
+            "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "gpt-4",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "Final report"}}],
+        })
+
+    async with _mock_client(reply) as client:
+        report = await synthesize_reviews(["review a", "review b"], _SUMMARY_CONFIG, client)
+
+    assert report == "Final report"
+    (body,) = requests
+    assert body['model'] == 'gpt-4'
+    assert body['messages'] == [
+        {"role": "system", "content": "Test prompt"},
+        {"role": "user", "content": "review a\n\n---\n\nreview b"},
+    ]
+
+_CHUNK_CONFIG = {'model_name': 'gpt-4', 'chunk_prompt': 'Review this', 'cache_dir': ''}
+
+def _sse_response(*deltas, usage=None):
+    """Serve a streamed chat completion: one event per delta, then an optional usage-only event"""
+    base = {"id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0, "model": "gpt-4"}
+    events = [{**base, "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]}
+              for delta in deltas]
+    if usage:
+        # With include_usage the last event carries the usage and no choices
+        events.append({**base, "choices": [], "usage": usage})
+    body = b"".join(b"data: " + orjson.dumps(event) + b"\n\n" for event in events) + b"data: [DONE]\n\n"
+    return httpx.Response(200, content=body, headers={"content-type": "text/event-stream"})
+
+async def test_process_chunk_accumulates_stream(caplog):
+    """Test that streamed deltas are joined and the final usage event is logged"""
+    requests = []
+    def stream(request):
+        requests.append(orjson.loads(request.content))
+        return _sse_response("- [LOW] ", "[Style] a.py:1", " - Example", usage={
+            "prompt_tokens": 120, "completion_tokens": 9, "total_tokens": 129,
+            "prompt_tokens_details": {"cached_tokens": 64},
+        })
+
+    chunk = [_file('a.py', _hunk(1, 2))]
+    with caplog.at_level("DEBUG"):
+        async with _mock_client(stream) as client:
+            review = await process_chunk(chunk, _CHUNK_CONFIG, client)
+
+    assert review == "- [LOW] [Style] a.py:1 - Example"
+    (body,) = requests
+    assert body['stream'] is True
+    assert body['stream_options'] == {"include_usage": True}
+    assert body['messages'][0] == {"role": "system", "content": "Review this"}
+    assert body['messages'][1]['content'].startswith("CODE DIFF:\nFile: a.py (modified)\n1: @@")
+    assert "Prompt tokens: 120, cached: 64" in caplog.text
+
+async def test_process_chunk_uses_review_cache(tmp_path):
+    """Test that a cache miss stores the streamed review and a rerun is served without a request"""
+    requests = []
+    def stream(request):
+        requests.append(request)
+        return _sse_response("- [LOW] [Style] a.py:1 - Example")
+
+    config = {**_CHUNK_CONFIG, 'cache_dir': str(tmp_path)}
+    chunk = [_file('a.py', _hunk(1, 2))]
+    async with _mock_client(stream) as client:
+        first = await process_chunk(chunk, config, client)
+        second = await process_chunk(chunk, config, client)
+        changed = await process_chunk([_file('a.py', _hunk(1, 3))], config, client)
+
+    assert first == second == changed == "- [LOW] [Style] a.py:1 - Example"
+    # The repeat is a hit; the changed patch is a miss with its own entry
+    assert len(requests) == 2
+    assert len(list(tmp_path.glob("*.md"))) == 2
+
+class _FakePR:
+    """Records the comments main() posts"""
+    def __init__(self):
+        self.comments = []
+
+    def create_comment(self, body):
+        self.comments.append(body)
+
+def _reviewed_files(body):
+    return sorted(set(re.findall(r"^File: (\S+)", body['messages'][1]['content'], re.MULTILINE)))
+
+class _FakeLLM:
+    """Answers chunk reviews with the files they cover and synthesis with a fixed report"""
+    def __init__(self, slow=()):
+        self.slow = slow
+        self.summaries = []
+
+    async def __call__(self, request):
+        body = orjson.loads(request.content)
+        if not body.get('stream'):
+            self.summaries.append(body['messages'][1]['content'])
+            return httpx.Response(200, json={
+                "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": "gpt-4",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "Final report"}}],
+            })
+        files = _reviewed_files(body)
+        if set(files) & set(self.slow):
+            # Finish after the other chunks so the reviews arrive out of order
+            await asyncio.sleep(0.05)
+        return _sse_response(f"review of {', '.join(files)}")
+
+@pytest.fixture
+def run_main(mock_env, monkeypatch, char_tokenizer):
+    """Run main() against canned PR file pages and a mock LLM, returning the posted comments
+
+    A page given as an exception makes that page's request fail with it.
+    """
+    async def run(pages, llm):
+        urls = [f"{_FakeRepo._api}/pulls/123/files"] + [f"{_FakeRepo._api}/pulls/123/files?page={n}"
+                                                        for n in range(2, len(pages) + 1)]
+        repo = _FakeRepo({url: _FakeResponse(page, next_url)
+                          for url, page, next_url in zip(urls, pages, urls[1:] + [None])})
+        pr = _FakePR()
+
+        def get_pull_request(github_token, repo_name, pr_number):
+            assert (repo_name, pr_number) == ('test-owner/test-repo', 123)
+            return repo, pr
+
+        monkeypatch.setattr(main_module, "get_pull_request", get_pull_request)
+        monkeypatch.setattr(main_module, "create_client", lambda openai_params: _mock_client(llm))
+        monkeypatch.setattr(main_module, "_get_tokenizer", lambda: char_tokenizer)
+        await main_module.main()
+        return pr.comments
+    return run
+
+async def test_main_synthesizes_reviews_in_chunk_order(run_main):
+    """Test that every chunk is reviewed and synthesized in file order, whatever order reviews finish in"""
+    llm = _FakeLLM(slow=['a.py'])
+    pages = [[_api_file('a.py', _hunk(1, 1500))], [_api_file('b.py', _hunk(1, 1500, "+b"))]]
+
+    assert await run_main(pages, llm) == ["Final report"]
+    assert llm.summaries == ["review of a.py\n\n---\n\nreview of b.py"]
+
+async def test_main_posts_nothing_when_a_page_fails(run_main):
+    """Test that a failed page fetch aborts the run instead of posting a partial review"""
+    llm = _FakeLLM()
+    error = httpx.HTTPStatusError("502 Bad Gateway", request=None, response=None)
+    pages = [[_api_file('a.py', _hunk(1, 1500))], error, [_api_file('c.py', _hunk(1, 1500, "+c"))]]
+
+    with pytest.raises(httpx.HTTPStatusError):
+        await run_main(pages, llm)
+    assert llm.summaries == []
+
+async def test_main_posts_a_single_review_without_synthesis(run_main):
+    """Test that a PR with one reviewable chunk posts that review and skips the synthesis call"""
+    llm = _FakeLLM()
+    pages = [[_api_file('a.py', _hunk(1, 1500)), _api_file('tiny.py')]]
+
+    assert await run_main(pages, llm) == ["review of a.py"]
+    assert llm.summaries == []
+
+async def test_main_appends_identical_changes(run_main):
+    """Test that files identical to a reviewed file are reviewed once and listed under the report"""
+    llm = _FakeLLM()
+    patch = _hunk(1, 1500)
+    pages = [[_api_file('a.py', patch)], [_api_file('copy.py', patch)]]
+
+    (comment,) = await run_main(pages, llm)
+    assert comment == "review of a.py" + format_duplicates([{'filename': 'copy.py', 'duplicate_of': 'a.py'}])
+    assert "- `copy.py`: identical to `a.py`" in comment